@@ -10,9 +10,14 @@ Repository: https://github.com/xamafe/dashy_deamons
 
 import json
 import os
+import re
 import sys
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
+from urllib.parse import quote
 from dateutil import tz
 
 # Check for required packages
@@ -20,40 +25,79 @@ try:
     from google.auth.transport.requests import Request
     from google.oauth2.credentials import Credentials
     from google_auth_oauthlib.flow import InstalledAppFlow
-    from googleapiclient.discovery import build
+    import requests
     from dotenv import load_dotenv
 except ImportError as e:
     print(f"Missing required package: {e}")
     print("Please install requirements: pip install -r requirements.txt")
     sys.exit(1)
 
-SCRIPT_DIR = Path(__file__).resolve().parent
+# orjson is optional, fall back to the stdlib encoder if it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# Load environment variables from .env file
-load_dotenv(dotenv_path=SCRIPT_DIR / '.env')
-# Configuration from environment variables
+SCRIPT_DIR = Path(__file__).resolve().parent
 
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
-CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', SCRIPT_DIR / 'credentials.json')
-TOKEN_FILE = os.getenv('GOOGLE_TOKEN_FILE',  SCRIPT_DIR / 'token.json')
-OUTPUT_FILE = os.getenv('OUTPUT_FILE', '/opt/dashy/public/calendar-feed.json')
 
+# Configuration from environment variables, set by load_environment()
+CREDENTIALS_FILE = None
+TOKEN_FILE = None
+OUTPUT_FILE = None
+ETAG_CACHE_FILE = None
+FEED_TITLE = None
+SUBTITLE_FORMAT = None
+ALL_DAY_LABEL = None
+
+EVENTS_URL = 'https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events'
+MAX_WORKERS = 16
+REQUEST_TIMEOUT = 10
+CALENDAR_ID_PATTERN = re.compile(r'^CALENDAR_(\d+)_ID$')
+# fromisoformat only understands a trailing 'Z' since Python 3.11
+FROMISOFORMAT_HANDLES_Z = sys.version_info >= (3, 11)
+
+
+def load_environment():
+    """Load the .env file (only once) and read the configuration from the environment"""
+    global CREDENTIALS_FILE, TOKEN_FILE, OUTPUT_FILE, ETAG_CACHE_FILE, FEED_TITLE, SUBTITLE_FORMAT, ALL_DAY_LABEL
+    
+    if not os.getenv('_DOTENV_LOADED'):
+        load_dotenv(dotenv_path=SCRIPT_DIR / '.env')
+        os.environ['_DOTENV_LOADED'] = '1'
+    
+    CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', SCRIPT_DIR / 'credentials.json')
+    TOKEN_FILE = os.getenv('GOOGLE_TOKEN_FILE',  SCRIPT_DIR / 'token.json')
+    OUTPUT_FILE = os.getenv('OUTPUT_FILE', '/opt/dashy/public/calendar-feed.json')
+    ETAG_CACHE_FILE = os.getenv('ETAG_CACHE_FILE', SCRIPT_DIR / '.etag_cache.json')
+    FEED_TITLE = os.getenv('FEED_TITLE', 'Heutige Termine')
+    SUBTITLE_FORMAT = os.getenv('SUBTITLE_FORMAT', '%A, %d.%B.%Y')
+    ALL_DAY_LABEL = os.getenv('ALL_DAY_LABEL', 'Ganztägig')
 
 def load_calendar_config():
     """Load calendar configuration from environment variables"""
+    load_environment()
     calendars = {}
+    env = os.environ
     
-    # Load calendars from environment (CALENDAR_1, CALENDAR_2, etc.)
-    i = 1
-    while True:
-        calendar_id = os.getenv(f'CALENDAR_{i}_ID')
-        calendar_name = os.getenv(f'CALENDAR_{i}_NAME')
+    # Load calendars from environment (CALENDAR_1, CALENDAR_2, etc.) in a single pass,
+    # gaps in the numbering are allowed
+    numbers = []
+    for key in env:
+        match = CALENDAR_ID_PATTERN.match(key)
+        if match:
+            numbers.append(match.group(1))
+    
+    for i in sorted(numbers, key=int):
+        calendar_id = env[f'CALENDAR_{i}_ID']
+        calendar_name = env.get(f'CALENDAR_{i}_NAME')
         
         if not calendar_id or not calendar_name:
-            break
+            print(f"⚠️  Skipping CALENDAR_{i}: both CALENDAR_{i}_ID and CALENDAR_{i}_NAME must be set")
+            continue
             
         calendars[calendar_id] = calendar_name
-        i += 1
     
     if not calendars:
         print("❌ No calendars configured!")
@@ -118,7 +162,7 @@ def authenticate():
             token.write(creds.to_json())
         print("✅ Authentication successful!")
     
-    return build('calendar', 'v3', credentials=creds)
+    return creds
 
 def run_manual_auth(flow):
     """Manual authentication for headless servers"""
@@ -146,6 +190,7 @@ def run_manual_auth(flow):
         print("Please try again with the correct authorization code")
         sys.exit(1)
 
+@lru_cache(maxsize=None)
 def get_theme_color(calendar_name):
     """Return theme-matching colors for different calendars"""
     # You can customize these colors to match your Dashy theme
@@ -170,11 +215,13 @@ def format_event_time(event, local_tz):
     
     # Check if it's an all-day event
     if 'date' in start:
-        return "Ganztägig", True
+        return ALL_DAY_LABEL, True
     
     # Parse datetime
     try:
         dt_string = start['dateTime']
+        if not FROMISOFORMAT_HANDLES_Z:
+            dt_string = dt_string.replace('Z', '+00:00')
         utc_dt = datetime.fromisoformat(dt_string)
         local_dt = utc_dt.astimezone(local_tz)
         return local_dt.strftime('%H:%M'), False
@@ -182,53 +229,108 @@ def format_event_time(event, local_tz):
         print(f"⚠️  Error parsing time for event '{event.get('summary', 'Unknown')}': {e}")
         return "Time TBD", False
 
-def fetch_calendar_events(service, calendar_id, calendar_name, local_tz, time_min, time_max):
-    """Fetch today's events from a specific calendar"""
+def load_etag_cache():
+    """Load the ETags and events of the previous run"""
+    try:
+        with open(ETAG_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_etag_cache(cache):
+    """Save the ETags and events for the next run"""
+    # Write to a temporary file and rename it, so a crash never leaves a corrupt cache
+    cache_path = Path(ETAG_CACHE_FILE)
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    try:
+        tmp_path.write_text(json.dumps(cache, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"⚠️  Could not save ETag cache: {e}")
+
+def create_session(creds):
+    """Create an HTTP session that sends the OAuth bearer token"""
+    session = requests.Session()
+    session.headers.update({'Authorization': f'Bearer {creds.token}'})
+    # One pooled keep-alive connection per worker thread
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+    return session
+
+def fetch_calendar_events(session, calendar_id, calendar_name, local_tz, time_min, time_max, cached=None):
+    """Fetch today's events from a specific calendar
+
+    Returns the formatted events and the new ETag cache entry (None on error).
+    """
     print(f"📅 Fetching events from: {calendar_name}")
     
-    # Get today's date range
-    now = datetime.now()
-    #start_of_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    #end_of_day = start_of_day + timedelta(days=1)
+    # Only revalidate the cached events if they were fetched for the same day
+    headers = {}
+    if cached and cached.get('time_min') == time_min and cached.get('time_max') == time_max:
+        headers['If-None-Match'] = cached['etag']
+    else:
+        cached = None
     
     try:
-        events_result = service.events().list(
-            calendarId=calendar_id,
-            timeMin=time_min.isoformat(),
-            timeMax=time_max.isoformat(),
-            singleEvents=True,
-            orderBy='startTime',
-            maxResults=50  # Limit to avoid too many events
-        ).execute()
+        response = session.get(
+            EVENTS_URL.format(calendar_id=quote(calendar_id, safe='')),
+            params={
+                'timeMin': time_min,
+                'timeMax': time_max,
+                'singleEvents': 'true',
+                'orderBy': 'startTime',
+                'maxResults': 50  # Limit to avoid too many events
+            },
+            headers=headers,
+            timeout=REQUEST_TIMEOUT
+        )
         
-        events = events_result.get('items', [])
-        print(f"   Found {len(events)} events")
+        if response.status_code == 304:
+            cache_entry = cached
+            events = cached['items']
+            print(f"   Not modified, reusing {len(events)} cached events")
+        else:
+            response.raise_for_status()
+            events_result = response.json()
+            
+            events = events_result.get('items', [])
+            print(f"   Found {len(events)} events")
+            
+            cache_entry = None
+            etag = response.headers.get('ETag') or events_result.get('etag')
+            if etag:
+                # Only keep the fields the feed is built from, not descriptions, attendees etc.
+                items = [{key: event[key] for key in ('summary', 'start') if key in event} for event in events]
+                cache_entry = {'etag': etag, 'time_min': time_min, 'time_max': time_max, 'items': items}
         
+        color = get_theme_color(calendar_name)
         formatted_events = []
         for event in events:
             time_str, is_all_day = format_event_time(event, local_tz)
+            start = event['start']
             
+            # Only the keys shown by Dashy, plus the sort key (all-day first, then by time)
             formatted_events.append({
                 'label': event.get('summary', 'No Title'),
                 'value': time_str,
                 'unit': calendar_name,
-                'color': get_theme_color(calendar_name),
-                'is_all_day': is_all_day,
-                'start_time': event['start'].get('dateTime', event['start'].get('date')),
-                'location': event.get('location', ''),
-                'description': event.get('description', '')[:100] + '...' if event.get('description', '') else ''
+                'color': color,
+                'sort_key': (0 if is_all_day else 1, start.get('dateTime') or start.get('date') or '')
             })
         
-        return formatted_events
+        return formatted_events, cache_entry
         
     except Exception as e:
         print(f"❌ Error fetching calendar '{calendar_name}': {e}")
-        return []
+        return [], None
 
 def generate_calendar_feed():
     """Main function to generate the calendar data feed"""
     print("🚀 Starting Dashy Calendar Feed Generator")
+    
+    # Load configuration
+    calendars = load_calendar_config()
     print(f"📁 Output file: {OUTPUT_FILE}")
+    print(f"📋 Configured calendars: {list(calendars.values())}")
     
     local_tz = tz.tzlocal()
     if local_tz is None:
@@ -244,49 +346,62 @@ def generate_calendar_feed():
     # 3. Define today's date range IN THE LOCAL TIMEZONE
     start_of_day = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
     end_of_day = start_of_day + timedelta(days=1)
+    time_min = start_of_day.isoformat()
+    time_max = end_of_day.isoformat()
 
-    # Load configuration
-    calendars = load_calendar_config()
-    print(f"📋 Configured calendars: {list(calendars.values())}")
-    
     # Authenticate
-    service = authenticate()
+    creds = authenticate()
+    session = create_session(creds)
     
-    # Fetch all events
+    # Fetch all events, one request per calendar in parallel
+    etag_cache = load_etag_cache()
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(calendars))) as executor:
+        futures = {
+            executor.submit(fetch_calendar_events, session, calendar_id, calendar_name, local_tz,
+                            time_min, time_max, etag_cache.get(calendar_id)): calendar_id
+            for calendar_id, calendar_name in calendars.items()
+        }
+        for future in as_completed(futures):
+            calendar_id = futures[future]
+            results[calendar_id], etag_cache[calendar_id] = future.result()
+    
+    # Drop entries of failed requests and calendars that are no longer configured
+    save_etag_cache({calendar_id: entry for calendar_id, entry in etag_cache.items()
+                     if calendar_id in calendars and entry})
+    
+    # Keep the configured calendar order for events with equal sort keys
     all_events = []
-    for calendar_id, calendar_name in calendars.items():
-        events = fetch_calendar_events(service, calendar_id, calendar_name, local_tz, start_of_day, end_of_day)
-        all_events.extend(events)
+    for calendar_id in calendars:
+        all_events.extend(results[calendar_id])
     
     # Sort events: all-day first, then by time
-    all_events.sort(key=lambda x: (not x['is_all_day'], x['start_time']))
+    all_events.sort(key=itemgetter('sort_key'))
+    for event in all_events:
+        del event['sort_key']
     
     # Create data feed structure for Dashy
-    now = datetime.now()
+    now = datetime.now(local_tz)
     feed_data = {
-        "title": "Heutige Termine",
-        "subtitle": now.strftime("%A, %d.%B.%Y"),
-        "items": [
-            {
-                "label": event['label'],
-                "value": event['value'],
-                "unit": event['unit'],
-                "color": event['color']
-            }
-            for event in all_events
-        ],
+        "title": FEED_TITLE,
+        "subtitle": now.strftime(SUBTITLE_FORMAT),
+        "items": all_events,
         "total": len(all_events),
-        "lastUpdated": now.isoformat() + 'Z'
+        "lastUpdated": now.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     }
     
     # Ensure output directory exists
     output_path = Path(OUTPUT_FILE)
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
-    # Save to file
+    # Save to a temporary file and rename it, so Dashy never reads a half-written feed
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
     try:
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(feed_data, f, indent=2, ensure_ascii=False)
+        if orjson is not None:
+            tmp_path.write_bytes(orjson.dumps(feed_data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE))
+        else:
+            tmp_path.write_text(json.dumps(feed_data, ensure_ascii=False, separators=(',', ':')) + '\n', encoding='utf-8')
+        os.replace(tmp_path, output_path)
         print(f"✅ Successfully generated calendar feed with {len(all_events)} events")
         print(f"📄 Saved to: {OUTPUT_FILE}")
     except Exception as e:
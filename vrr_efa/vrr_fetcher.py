@@ -7,13 +7,54 @@ Automatically resolves stop IDs from city/stop name combinations
 
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import os
 from datetime import datetime, timedelta
 from pathlib import Path
 import sys
 from typing import Dict, List, Any, Optional, Tuple
 import argparse
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# orjson is optional, fall back to the stdlib json module if it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Default maximum number of concurrent requests to the EFA server
+MAX_PARALLEL_REQUESTS = 8
+
+# Map EFA motType to more readable vehicle types
+VEHICLE_TYPE_MAP = {
+    '0': 'Zug', '1': 'S-Bahn', '2': 'U-Bahn', '3': 'Straßenbahn',
+    '4': 'Stadtbus', '5': 'Regionalbus', '6': 'Schnellbus',
+    '7': 'Bus', '8': 'Sonstige', '9': 'Fähre', '10': 'AST'
+}
+
+
+@lru_cache(maxsize=None)
+def is_low_floor(vehicle_type: str) -> bool:
+    """Check if "Niederflur" is in the vehicle type, cached per distinct type"""
+    return 'niederflur' in vehicle_type.lower()
+
+
+def json_loads(data) -> Any:
+    """Parse JSON from str or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Serialize an object to pretty-printed UTF-8 JSON with a trailing newline"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8') + b'\n'
 
 
 class VRRFetcher:
@@ -21,6 +62,15 @@ class VRRFetcher:
         self.config_file = config_file
         self.debug_api = debug_api
         self.config = self.load_config()
+        # Global settings that are read for every stop or request
+        self.timeout = self.config.get('timeout', 30)
+        self.default_max_departures = self.config.get('max_departures_per_stop', 10)
+        self.include_dates = self.config.get('include_dates', False)
+        try:
+            max_parallel_requests = int(self.config.get('max_parallel_requests', MAX_PARALLEL_REQUESTS))
+        except (TypeError, ValueError):
+            max_parallel_requests = MAX_PARALLEL_REQUESTS
+        self.max_parallel_requests = max(1, max_parallel_requests)
         self.base_url = "https://efa.vrr.de/vrr"
         self.dm_endpoint = f"{self.base_url}/XML_DM_REQUEST"
         self.stopfinder_endpoint = f"{self.base_url}/XML_STOPFINDER_REQUEST"
@@ -29,6 +79,13 @@ class VRRFetcher:
             'User-Agent': 'VRR-Dashy-Fetcher/1.0',
             'Accept-Charset': 'utf-8'
         })
+        # All requests go to efa.vrr.de, keep one connection alive per worker and retry on gateway errors
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.max_parallel_requests,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
         
         # Setup logging
         logging.basicConfig(
@@ -37,12 +94,17 @@ class VRRFetcher:
         )
         self.logger = logging.getLogger(__name__)
         self.logger.info(f"Using configuration file: {self.config_file}")
+        
+        # Stop IDs resolved by the stopfinder, keyed by "city:name" and persisted next to the configuration
+        self.stop_id_cache_file = Path(self.config_file).with_name('stop_id_cache.json')
+        self.stop_id_cache: Dict[str, Optional[str]] = self.load_stop_id_cache()
+        self.stop_id_cache_changed = False
 
     def load_config(self) -> Dict[str, Any]:
         """Load configuration from JSON file"""
         try:
-            with open(self.config_file, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+            with open(self.config_file, 'rb') as f:
+                config = json_loads(f.read())
             return config
         except FileNotFoundError:
             self.logger.error(f"Configuration file {self.config_file} not found")
@@ -55,12 +117,34 @@ class VRRFetcher:
     def save_config(self):
         """Save current configuration back to file"""
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, indent=2, ensure_ascii=False)
+            with open(self.config_file, 'wb') as f:
+                f.write(json_dumps(self.config))
             self.logger.debug("Configuration file updated")
         except Exception as e:
             self.logger.error(f"Error saving configuration: {e}")
 
+    def load_stop_id_cache(self) -> Dict[str, Optional[str]]:
+        """Load previously resolved stop IDs"""
+        try:
+            with open(self.stop_id_cache_file, 'rb') as f:
+                return json_loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Ignoring unreadable stop ID cache {self.stop_id_cache_file}: {e}")
+            return {}
+
+    def save_stop_id_cache(self):
+        """Save resolved stop IDs, failed lookups are not persisted"""
+        cache = {key: stop_id for key, stop_id in self.stop_id_cache.items() if stop_id}
+        try:
+            with open(self.stop_id_cache_file, 'wb') as f:
+                f.write(json_dumps(cache))
+            self.stop_id_cache_changed = False
+            self.logger.debug("Stop ID cache updated")
+        except Exception as e:
+            self.logger.error(f"Error saving stop ID cache: {e}")
+
     def create_sample_config(self):
         """Create a sample configuration file"""
         sample_config = {
@@ -91,8 +175,8 @@ class VRRFetcher:
             ]
         }
         
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            json.dump(sample_config, f, indent=2, ensure_ascii=False)
+        with open(self.config_file, 'wb') as f:
+            f.write(json_dumps(sample_config))
         
         self.logger.info(f"Created sample configuration file: {self.config_file}")
         self.logger.info("Please edit the configuration file with your stops and run again")
@@ -112,12 +196,11 @@ class VRRFetcher:
             response = self.session.get(
                 self.stopfinder_endpoint, 
                 params=params, 
-                timeout=self.config.get('timeout', 30)
+                timeout=self.timeout
             )
             response.raise_for_status()
-            response.encoding = 'utf-8'
             
-            data = response.json()
+            data = json_loads(response.content)
             
             # Parse the stopfinder response
             if 'stopFinder' in data and 'points' in data['stopFinder']:
@@ -130,11 +213,11 @@ class VRRFetcher:
                             return point['ref']['id']
                     # Multiple results - take the first exact match
                     elif isinstance(points['point'], list):
+                        search_name = name.lower()
                         for point in points['point']:
                             if isinstance(point, dict) and 'ref' in point:
                                 # Check if this is an exact match
                                 point_name = point.get('name', '').lower()
-                                search_name = name.lower()
                                 if search_name in point_name or point_name.startswith(search_name):
                                     return point['ref']['id']
                         # If no exact match, take the first one
@@ -165,29 +248,34 @@ class VRRFetcher:
             self.logger.error(f"Missing city or name in stop configuration: {stop_config}")
             return None
         
+        cache_key = f"{city.lower().strip()}:{name.lower().strip()}"
+        if cache_key in self.stop_id_cache:
+            stop_id = self.stop_id_cache[cache_key]
+            if stop_id:
+                stop_config['stop_id'] = stop_id
+                self.logger.info(f"Using cached stop ID {stop_id} for {city}:{name}")
+            return stop_id
+        
         self.logger.info(f"Searching for stop ID: {city}:{name}")
         stop_id = self.find_stop_id(city, name)
+        self.stop_id_cache[cache_key] = stop_id
         
         if stop_id:
-            # Save the found ID back to configuration
+            # Store the found ID in the configuration, fetch_all_stops saves it once at the end
+            self.stop_id_cache_changed = True
             stop_config['stop_id'] = stop_id
-            self.save_config()
-            self.logger.info(f"Found and saved stop ID {stop_id} for {city}:{name}")
+            self.logger.info(f"Found stop ID {stop_id} for {city}:{name}")
         
         return stop_id
 
-    def should_include_departure(self, departure: Dict[str, Any], platform_filter: List[str]) -> bool:
-        """Check if departure should be included based on platform filter"""
-        if not platform_filter:  # Empty list means include all platforms
-            return True
-        
-        departure_platform = departure.get('platform', '')
-        return departure_platform in platform_filter
+    def fetch_departures(self, stop_id: str, max_departures: int = 10, platform_filter: List[str] = None,
+                         include_dates: bool = False, now: Optional[datetime] = None) -> Optional[List[Dict[str, Any]]]:
+        """Fetch departure data for a specific stop, departure_date/real_date are only added if include_dates is set"""
+        if now is None:
+            now = datetime.now()
 
-    def fetch_departures(self, stop_id: str, max_departures: int = 10, platform_filter: List[str] = None) -> Optional[List[Dict[str, Any]]]:
-        """Fetch departure data for a specific stop"""
-        if platform_filter is None:
-            platform_filter = []
+        # Empty list means include all platforms
+        platforms = set(platform_filter) if platform_filter else None
             
         params = {
             'outputFormat': 'JSON',
@@ -207,31 +295,34 @@ class VRRFetcher:
             response = self.session.get(
                 self.dm_endpoint, 
                 params=params, 
-                timeout=self.config.get('timeout', 30)
+                timeout=self.timeout
             )
             response.raise_for_status()
-            response.encoding = 'utf-8'
             
-            data = response.json()
+            data = json_loads(response.content)
             
             # Debug: Save raw API response if requested
             if self.debug_api:
                 debug_file = f"debug_api_dm_{stop_id}_{int(time.time())}.json"
-                with open(debug_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
+                Path(debug_file).write_bytes(json_dumps(data))
                 self.logger.info(f"Saved raw API response to {debug_file}")
             
             # Debug: Log the raw response structure for troubleshooting
-            self.logger.debug(f"API Response keys: {list(data.keys()) if data else 'None'}")
-            if 'departureList' in data:
-                self.logger.debug(f"Found {len(data['departureList'])} departures")
-                if data['departureList']:
-                    self.logger.debug(f"First departure keys: {list(data['departureList'][0].keys())}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("API Response keys: %s", list(data.keys()) if data else None)
+                if 'departureList' in data:
+                    self.logger.debug("Found %d departures", len(data['departureList']))
+                    if data['departureList']:
+                        self.logger.debug("First departure keys: %s", list(data['departureList'][0].keys()))
             
             # Parse the EFA response
             departures = []
             if 'departureList' in data and data['departureList']:
                 for departure in data['departureList']:
+                    # Apply platform filter
+                    if platforms is not None and departure.get('platform', '') not in platforms:
+                        continue
+                    
                     serving_line = departure.get('servingLine', {})
                     date_time = departure.get('dateTime', {})
                     real_date_time = departure.get('realDateTime', {})
@@ -243,37 +334,33 @@ class VRRFetcher:
                     real_date = ''
                     
                     # Build time from individual components
+                    # EFA sends the components as strings, ':0>2' pads both strings and ints
                     if date_time:
-                        hour = str(date_time.get('hour', 0)).zfill(2)
-                        minute = str(date_time.get('minute', 0)).zfill(2)
-                        departure_time = f"{hour}:{minute}"
-                        
-                        day = str(date_time.get('day', 1)).zfill(2)
-                        month = str(date_time.get('month', 1)).zfill(2)
-                        year = str(date_time.get('year', 2025))
-                        departure_date = f"{day}.{month}.{year}"
+                        departure_time = f"{date_time.get('hour', 0):0>2}:{date_time.get('minute', 0):0>2}"
+                        if include_dates:
+                            departure_date = f"{date_time.get('day', 1):0>2}.{date_time.get('month', 1):0>2}.{date_time.get('year', 2025)}"
                     
                     if real_date_time:
-                        hour = str(real_date_time.get('hour', 0)).zfill(2)
-                        minute = str(real_date_time.get('minute', 0)).zfill(2)
-                        real_time = f"{hour}:{minute}"
-                        
-                        day = str(real_date_time.get('day', 1)).zfill(2)
-                        month = str(real_date_time.get('month', 1)).zfill(2)
-                        year = str(real_date_time.get('year', 2025))
-                        real_date = f"{day}.{month}.{year}"
+                        real_time = f"{real_date_time.get('hour', 0):0>2}:{real_date_time.get('minute', 0):0>2}"
+                        if include_dates:
+                            real_date = f"{real_date_time.get('day', 1):0>2}.{real_date_time.get('month', 1):0>2}.{real_date_time.get('year', 2025)}"
                     
-                    # Use countdown as fallback for time calculation
+                    # Parse the countdown once, it is used for the fallback time and the display time
                     countdown_minutes = departure.get('countdown')
-                    if countdown_minutes and not departure_time:
+                    countdown_int = None
+                    if countdown_minutes:
                         try:
                             countdown_int = int(countdown_minutes)
-                            future_time = datetime.now() + timedelta(minutes=countdown_int)
-                            departure_time = future_time.strftime('%H:%M')
-                            departure_date = future_time.strftime('%d.%m.%Y')
                         except (ValueError, TypeError):
                             pass
                     
+                    # Use countdown as fallback for time calculation
+                    if countdown_int is not None and not departure_time:
+                        future_time = now + timedelta(minutes=countdown_int)
+                        departure_time = future_time.strftime('%H:%M')
+                        if include_dates:
+                            departure_date = future_time.strftime('%d.%m.%Y')
+                    
                     # Extract delay from serving line
                     delay = 0
                     if serving_line.get('delay'):
@@ -289,40 +376,26 @@ class VRRFetcher:
                     
                     # Map motType to more readable vehicle types
                     mot_type = serving_line.get('motType', '5')
-                    vehicle_type_map = {
-                        '0': 'Zug', '1': 'S-Bahn', '2': 'U-Bahn', '3': 'Straßenbahn',
-                        '4': 'Stadtbus', '5': 'Regionalbus', '6': 'Schnellbus',
-                        '7': 'Bus', '8': 'Sonstige', '9': 'Fähre', '10': 'AST'
-                    }
-                    
-                    if mot_type in vehicle_type_map:
-                        vehicle_type = vehicle_type_map[mot_type]
+                    if mot_type in VEHICLE_TYPE_MAP:
+                        vehicle_type = VEHICLE_TYPE_MAP[mot_type]
                     
                     # Check if this is real-time data
                     is_realtime = serving_line.get('realtime') == '1'
                     
                     # Create formatted time display using countdown if available
                     display_time = departure_time
-                    if countdown_minutes:
-                        try:
-                            countdown_int = int(countdown_minutes)
-                            if countdown_int <= 0:
-                                display_time = "sofort"
-                            elif countdown_int < 60:
-                                display_time = f"{countdown_int} Min"
-                            else:
-                                display_time = departure_time
-                        except (ValueError, TypeError):
-                            pass
+                    if countdown_int is not None:
+                        if countdown_int <= 0:
+                            display_time = "sofort"
+                        elif countdown_int < 60:
+                            display_time = f"{countdown_int} Min"
                     
                     dep_info = {
                         'line': serving_line.get('number', 'Unknown'),
                         'destination': serving_line.get('direction', 'Unknown'),
                         'platform': departure.get('platform', ''),
                         'departure_time': departure_time,
-                        'departure_date': departure_date,
                         'real_time': real_time,
-                        'real_date': real_date,
                         'countdown_minutes': countdown_minutes,
                         'display_time': display_time,
                         'delay': delay,
@@ -334,23 +407,25 @@ class VRRFetcher:
                         'operator': departure.get('operator', {}).get('name', ''),
                         'accessibility': {
                             'wheelchair': False,  # Not clearly available in this API version
-                            'low_floor': vehicle_type.lower().find('niederflur') >= 0  # Check if "Niederflur" in name
+                            'low_floor': is_low_floor(vehicle_type)
                         }
                     }
                     
+                    if include_dates:
+                        dep_info['departure_date'] = departure_date
+                        dep_info['real_date'] = real_date
+                    
                     # Add stop sequence if available
                     if 'prevStopSeq' in departure:
                         dep_info['previous_stops'] = [
                             stop.get('name', '') for stop in departure['prevStopSeq']
                         ]
                     
-                    # Apply platform filter
-                    if self.should_include_departure(dep_info, platform_filter):
-                        departures.append(dep_info)
-                        
-                        # Stop when we have enough departures after filtering
-                        if len(departures) >= max_departures:
-                            break
+                    departures.append(dep_info)
+                    
+                    # Stop when we have enough departures after filtering
+                    if len(departures) >= max_departures:
+                        break
             
             return departures
             
@@ -366,14 +441,19 @@ class VRRFetcher:
 
     def fetch_all_stops(self) -> Dict[str, Any]:
         """Fetch departure data for all configured stops"""
+        # One reference time for the whole refresh
+        now = datetime.now()
+        now_iso = now.isoformat()
         result = {
-            'last_updated': datetime.now().isoformat(),
+            'last_updated': now_iso,
             'update_interval_minutes': 10,  # Default update interval
             'stops': {}
         }
         
         config_changed = False
         
+        # Resolve stop IDs first, this may update the configuration
+        enabled_stops = []
         for stop_config in self.config.get('stops', []):
             if not stop_config.get('enabled', True):
                 stop_display_name = f"{stop_config.get('city', 'Unknown')} {stop_config.get('name', 'Unknown')}"
@@ -381,59 +461,79 @@ class VRRFetcher:
                 continue
                 
             # Resolve stop ID
+            had_stop_id = bool(stop_config.get('stop_id'))
             stop_id = self.resolve_stop_id(stop_config)
             if not stop_id:
                 continue
                 
             # If we added a stop_id, mark config as changed
-            if 'stop_id' not in stop_config:
+            if not had_stop_id:
                 config_changed = True
             
-            city = stop_config.get('city', 'Unknown')
-            name = stop_config.get('name', 'Unknown')
-            stop_display_name = f"{city} {name}"
-            max_deps = stop_config.get('max_departures', self.config.get('max_departures_per_stop', 10))
-            platform_filter = stop_config.get('platforms', [])
-            
-            # Log platform filtering info
-            if platform_filter:
-                self.logger.info(f"Fetching departures for {stop_display_name} (ID: {stop_id}) - Platforms: {', '.join(platform_filter)}")
-            else:
-                self.logger.info(f"Fetching departures for {stop_display_name} (ID: {stop_id}) - All platforms")
-                
-            departures = self.fetch_departures(stop_id, max_deps, platform_filter)
-            
-            if departures is not None:
-                result['stops'][stop_display_name] = {
-                    'city': city,
-                    'name': name,
-                    'stop_id': stop_id,
-                    'platforms': platform_filter,
-                    'departures': departures,
-                    'last_updated': datetime.now().isoformat(),
-                    'count': len(departures)
-                }
-                platform_info = f" (platforms: {', '.join(platform_filter)})" if platform_filter else " (all platforms)"
-                self.logger.info(f"Successfully fetched {len(departures)} departures for {stop_display_name}{platform_info}")
-            else:
-                result['stops'][stop_display_name] = {
-                    'city': city,
-                    'name': name,
-                    'stop_id': stop_id,
-                    'platforms': platform_filter,
-                    'departures': [],
-                    'last_updated': datetime.now().isoformat(),
-                    'count': 0,
-                    'error': 'Failed to fetch data'
-                }
-                self.logger.warning(f"Failed to fetch departures for {stop_display_name}")
+            enabled_stops.append((stop_config, stop_id))
+        
+        # Fetch departures of all stops in parallel, results keep the configured order
+        if enabled_stops:
+            max_workers = min(self.max_parallel_requests, len(enabled_stops))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                stop_results = list(executor.map(lambda stop: self.fetch_stop(*stop, now), enabled_stops))
+        else:
+            stop_results = []
+        
+        for stop_display_name, stop_data in stop_results:
+            result['stops'][stop_display_name] = stop_data
         
         # Save config if we added any stop IDs
         if config_changed:
             self.save_config()
+        if self.stop_id_cache_changed:
+            self.save_stop_id_cache()
         
         return result
 
+    def fetch_stop(self, stop_config: Dict[str, Any], stop_id: str, now: datetime) -> Tuple[str, Dict[str, Any]]:
+        """Fetch departure data for a single stop, returns its display name and data"""
+        city = stop_config.get('city', 'Unknown')
+        name = stop_config.get('name', 'Unknown')
+        stop_display_name = f"{city} {name}"
+        max_deps = stop_config.get('max_departures', self.default_max_departures)
+        platform_filter = stop_config.get('platforms', [])
+        
+        # Log platform filtering info
+        if platform_filter:
+            self.logger.info(f"Fetching departures for {stop_display_name} (ID: {stop_id}) - Platforms: {', '.join(platform_filter)}")
+        else:
+            self.logger.info(f"Fetching departures for {stop_display_name} (ID: {stop_id}) - All platforms")
+            
+        departures = self.fetch_departures(stop_id, max_deps, platform_filter, self.include_dates, now)
+        
+        if departures is not None:
+            stop_data = {
+                'city': city,
+                'name': name,
+                'stop_id': stop_id,
+                'platforms': platform_filter,
+                'departures': departures,
+                'last_updated': now.isoformat(),
+                'count': len(departures)
+            }
+            platform_info = f" (platforms: {', '.join(platform_filter)})" if platform_filter else " (all platforms)"
+            self.logger.info(f"Successfully fetched {len(departures)} departures for {stop_display_name}{platform_info}")
+        else:
+            stop_data = {
+                'city': city,
+                'name': name,
+                'stop_id': stop_id,
+                'platforms': platform_filter,
+                'departures': [],
+                'last_updated': now.isoformat(),
+                'count': 0,
+                'error': 'Failed to fetch data'
+            }
+            self.logger.warning(f"Failed to fetch departures for {stop_display_name}")
+        
+        return stop_display_name, stop_data
+
     def save_data(self, data: Dict[str, Any]) -> bool:
         """Save data to JSON file"""
         output_file = self.config.get('output_file', '.')
@@ -448,8 +548,11 @@ class VRRFetcher:
             # Create directory if it doesn't exist
             output_path.parent.mkdir(parents=True, exist_ok=True)
             
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            # Write to a temporary file and rename it, so the dashboard never reads a half-written file
+            tmp_path = output_path.with_name(output_path.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(json_dumps(data))
+            os.replace(tmp_path, output_path)
             
             self.logger.info(f"Data saved to {output_path}")
             return True
@@ -500,6 +603,7 @@ def main():
         for stop in fetcher.config.get('stops', []):
             if 'stop_id' in stop:
                 del stop['stop_id']
+        fetcher.stop_id_cache.clear()
         fetcher.logger.info("Forcing re-resolution of all stop IDs")
     
     fetcher.run()